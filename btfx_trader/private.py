@@ -1,29 +1,46 @@
 import logging
 import time
-from collections import deque, defaultdict, OrderedDict
-from contextlib import suppress
-from queue import Empty
-from threading import Thread, Event
+from collections import defaultdict, OrderedDict
+from functools import lru_cache
+from threading import Condition, Event, Thread, TIMEOUT_MAX
 
 from btfxwss import BtfxWss
-from .public import get_symbols_as_updated
+from .public import get_symbols_as_updated, notify_on_data
 
 log = logging.getLogger(__name__)
 
 
 def _jsonify_orders(data):
     return [
-        (datum[0],
-         dict(
-             symbol=datum[3][1:].upper(),
-             price=datum[16],
-             executed_price=datum[17],
-             amount=datum[7],
-             executed=datum[7] - datum[6],
-             remaining=datum[6],
-             status=datum[13].split()[0],
-             timestamp=datum[5] / 1000
-         )) for datum in data]
+        (datum[0], {
+            'symbol': datum[3][1:].upper(),
+            'price': datum[16],
+            'executed_price': datum[17],
+            'amount': datum[7],
+            'executed': datum[7] - datum[6],
+            'remaining': datum[6],
+            'status': datum[13].split(None, 1)[0],
+            'timestamp': datum[5] / 1000
+        }) for datum in data]
+
+
+def _order_timestamp(item):
+    return item[1]['timestamp']
+
+
+@lru_cache(maxsize=None)
+def _currency(symbol):
+    """Wallet currency of a ticker symbol (e.g. 'BTCUSD' -> 'btc')"""
+    symbol = symbol.lower()
+    # only the quote suffix is removed ('USDTUSD' -> 'usdt')
+    return symbol[:-3] if len(symbol) > 3 and symbol.endswith('usd') \
+        else symbol
+
+
+@lru_cache(maxsize=None)
+def _pair(symbol):
+    """Ticker symbol for a symbol or currency (e.g. 'btc' -> 'BTCUSD')"""
+    return _currency(symbol).upper() + 'USD'
 
 
 class _Account:
@@ -31,17 +48,23 @@ class _Account:
     Class for parsing live web socket data
     from bitfinex into user-friendly interface
     """
+    _max_order_history = 100
+
     def __init__(self):
         self._handlers = {
             'o': self._handle_order,
             't': self._handle_ticker,
             'w': self._handle_wallet
         }
-        self._executed_orders = deque(maxlen=100)
+        # held while a websocket message is handled, notified afterwards
+        self._updated = Condition()
+        self._executed_orders = OrderedDict()
+        self._last_executed_id = None
         self._orders = OrderedDict()
         self._prices = defaultdict(float)
 
-        self._available_balances = defaultdict(float)
+        # Currency held by active orders, kept in step with self._orders
+        self._reserved = defaultdict(float)
         self._wallets = defaultdict(float)
 
     @property
@@ -51,12 +74,8 @@ class _Account:
         :return: dict: available trading balances
         """
         balances = self._wallets.copy()
-        for order in self._orders.values():
-            if order['remaining'] < 0:
-                symbol = order['symbol'].lower().replace('usd', '')
-                balances[symbol] += order['remaining']
-            else:
-                balances['usd'] -= order['remaining'] * order['price']
+        for currency, amount in self._reserved.copy().items():
+            balances[currency] -= amount
         return defaultdict(float,
                            **{c: round(balances[c], 8) for c in balances})
 
@@ -64,15 +83,17 @@ class _Account:
     def executed_orders(self):
         """
         Sorted historical executed orders (earliest first) addressed by id
-        :return: OrderedDict: orders executed since initialization
+        :return: OrderedDict: copy of orders executed since initialization
         """
-        return OrderedDict(self._executed_orders)
+        with self._updated:
+            return self._executed_orders.copy()
 
     @property
     def orders(self):
         """
         Sorted currently active orders (earliest first) addressed by order id
-        :return: OrderedDict: currently active orders
+        :return: OrderedDict: currently active orders (live, must not
+            be mutated - reserved balances are kept in step with it)
         """
         return self._orders
 
@@ -82,9 +103,10 @@ class _Account:
         Ratio of total value invested in each symbol (excluding other symbols)
         :return: dict: symbol positions
         """
+        value = self.value
         return defaultdict(float, **{
-            symbol: (self._wallets[symbol.lower().replace('usd', '')]
-                     * self._prices[symbol]) / self.value
+            symbol: (self._wallets[_currency(symbol)]
+                     * self._prices[symbol]) / value
             for symbol in self._prices
         })
 
@@ -115,9 +137,28 @@ class _Account:
                  _id, symbol, action, 'BUY' if amount > 0 else 'SELL',
                  abs(amount), abs(amount * price), price)
 
+    def _reserve(self, order, sign):
+        if order['remaining'] < 0:
+            currency = _currency(order['symbol'])
+            self._reserved[currency] -= sign * order['remaining']
+        else:
+            self._reserved['usd'] += sign * order['remaining'] * order['price']
+
+    def _unreserve(self, _id):
+        self._reserve(self._orders.pop(_id), -1)
+        if not self._orders:
+            # drop accumulated float error once nothing is reserved
+            self._reserved.clear()
+
     def _handle_order_update(self, cmd, orders):
-        for _id, order in sorted(orders, key=lambda t: t[1]['timestamp']):
+        if cmd == 'os':
+            # only snapshots carry more than one order
+            orders = sorted(orders, key=_order_timestamp)
+        for _id, order in orders:
+            if _id in self._orders:
+                self._reserve(self._orders[_id], -1)
             self._orders[_id] = order
+            self._reserve(order, 1)
             if cmd == 'on':
                 self._log_order('SUBMIT', _id, order['symbol'],
                                 order['amount'], order['price'])
@@ -128,11 +169,17 @@ class _Account:
                 self._log_order('CANCEL', _id, order['symbol'],
                                 order['amount'], order['price'])
             else:
-                self._executed_orders.append((_id, order))
+                self._add_executed(_id, order)
                 self._log_order('EXECUTE', _id, order['symbol'],
                                 order['executed'], order['executed_price'])
             if _id in self._orders:
-                del self._orders[_id]
+                self._unreserve(_id)
+
+    def _add_executed(self, _id, order):
+        if len(self._executed_orders) >= self._max_order_history:
+            self._executed_orders.popitem(last=False)
+        self._executed_orders[_id] = order
+        self._last_executed_id = _id
 
     def _handle_order(self, cmd, data):
         if cmd != 'os':
@@ -145,9 +192,10 @@ class _Account:
 
     def _handle_ticker(self, cmd, data):
         symbol = cmd[1:]
-        weighted_mid = (data[0][0] * data[0][1] +
-                        data[0][2] * data[0][3]) / (data[0][1] + data[0][3])
-        self._prices[symbol] = weighted_mid
+        # bid, bid_size, ask, ask_size, ...
+        row = data[0]
+        self._prices[symbol] = (row[0] * row[1] + row[2] * row[3]) / \
+            (row[1] + row[3])
 
     def _handle_wallet(self, cmd, data):
         if cmd == 'ws':
@@ -158,7 +206,9 @@ class _Account:
             self._wallets[data[1].lower()] = float(data[2])
 
     def _update(self, cmd, data):
-        self._handlers[cmd[0]](cmd, data)
+        with self._updated:
+            self._handlers[cmd[0]](cmd, data)
+            self._updated.notify_all()
 
 
 class Trader(_Account):
@@ -167,9 +217,10 @@ class Trader(_Account):
     :param key: str: Bitfinex api-key
     :param secret:  str: Bitfinex api-secret
     """
-    _sleep_time = 0.01
+    _wait_timeout = 1.
     _min_order_value = 35.
-    _max_order_history = 100
+    _trade_value_msg = \
+        'Trade value ($%.2f) is %s available trade value ($%.2f)'
     _trade_types = {'market', 'limit'}
     _sources = (
         'Orders', 'Order New', 'Order Update', 'Order Cancel', 'Wallets'
@@ -178,9 +229,14 @@ class Trader(_Account):
     def __init__(self, key, secret):
         super(Trader, self).__init__()
         self.symbols = []
-        self.symbols_gen = get_symbols_as_updated()
+        # (update command, ticker queue) for each subscribed symbol
+        self._ticker_queues = []
         self.wss = BtfxWss(key=key, secret=secret, log_level='CRITICAL')
         self._disconnect_event = Event()
+        self.symbols_gen = get_symbols_as_updated(
+            stop_event=self._disconnect_event)
+        # set by the account and ticker queues read by _receive
+        self._data_event = Event()
         self._receiver = None
 
     def cancel(self, _id):
@@ -199,15 +255,15 @@ class Trader(_Account):
         :return: None
         """
         now = time.time()
-        for _id, order in self._orders.copy().items():
-            if now - order['timestamp'] > older_than:
-                self.cancel(_id)
+        ids = [_id for _id, order in self._orders.copy().items()
+               if now - order['timestamp'] > older_than]
+        if ids:
+            self.wss.cancel_order(multi=True, id=ids)
 
     def connect(self):
         """Open a connection to a Bitfinex websocket"""
         self.wss.start()
-        while not self.wss.conn.connected.is_set():
-            time.sleep(1e-4)
+        self.wss.conn.connected.wait()
         self.wss.authenticate()
         # This thread will wait for 99.999% of its life
         subscriber_thread = Thread(target=self._subscribe)
@@ -220,6 +276,7 @@ class Trader(_Account):
     def close(self):
         """Close the connection to the Bitfinex websocket"""
         self._disconnect_event.set()
+        self._data_event.set()
         for symbol in self.symbols:
             self.wss.unsubscribe_from_ticker(symbol)
         self.wss.stop()
@@ -271,19 +328,22 @@ class Trader(_Account):
         :return: int:
             If return_id is True, then order id is returned, otherwise None
 
-        :raises: AssertionError:
+        :raises: ValueError:
             If values passed are non-consistent
         """
 
-        assert dollar_amount or ratio or value_ratio, \
-            'Must provide either `dollar_amount`, `ratio` or `value_ratio`'
-        assert sum(bool(i) for i in [dollar_amount, ratio, value_ratio]) == 1,\
-            'Must provide only 1 of `dollar_amount`, `ratio` or `value_ratio`'
-        assert trade_type.lower() in self._trade_types, \
-            'Unknown trade type, try one of these: %s' % str(self._trade_types)
-
-        symbol_lower = symbol.lower().replace('usd', '')
-        symbol = symbol.upper().split('USD')[0] + 'USD'
+        if not (dollar_amount or ratio or value_ratio):
+            raise ValueError('Must provide either `dollar_amount`, '
+                             '`ratio` or `value_ratio`')
+        if sum(bool(i) for i in [dollar_amount, ratio, value_ratio]) != 1:
+            raise ValueError('Must provide only 1 of `dollar_amount`, '
+                             '`ratio` or `value_ratio`')
+        if trade_type.lower() not in self._trade_types:
+            raise ValueError('Unknown trade type, try one of these: %s'
+                             % str(self._trade_types))
+
+        symbol_lower = _currency(symbol)
+        symbol = _pair(symbol)
         buying = (dollar_amount or ratio or value_ratio) > 0
 
         if price == 'market' or trade_type == 'market':
@@ -293,7 +353,8 @@ class Trader(_Account):
         if pad_price:
             delta = price * pad_price
             price += max(delta, 0.01) if buying else min(-delta, -0.01)
-        assert price >= 0.01, 'Price cannot be less than $0.01'
+        if price < 0.01:
+            raise ValueError('Price cannot be less than $0.01')
 
         if buying:
             max_amount = self.available_balances['usd'] / price
@@ -309,18 +370,15 @@ class Trader(_Account):
                          max_amount)
         amount, max_amount = round(amount, 8), round(max_amount, 8)
 
-        assertion_msg = 'Trade value (${:.2f}) is %s available trade value ' \
-                        '($%.2f)'.format(abs(amount * price))
-        assert abs(amount) >= self._min_order_value / price, \
-            assertion_msg % ('below minimum', self._min_order_value)
-        assert abs(amount) <= max_amount, \
-            assertion_msg % ('above maximum', max_amount * price)
+        if abs(amount) < self._min_order_value / price:
+            raise ValueError(self._trade_value_msg % (
+                abs(amount * price), 'below minimum', self._min_order_value))
+        if abs(amount) > max_amount:
+            raise ValueError(self._trade_value_msg % (
+                abs(amount * price), 'above maximum', max_amount * price))
 
         current_order_ids = set(self._orders.keys())
-        if len(self._executed_orders) == 0:
-            last_executed_id = None
-        else:
-            last_executed_id = self._executed_orders[-1][0]
+        last_executed_id = self._last_executed_id
 
         self.wss.new_order(
             cid=int(time.time()),
@@ -330,24 +388,29 @@ class Trader(_Account):
             price="%.2f" % price,
         )
 
-        while return_id:
-            for _id in self._orders.copy().keys():
-                # new order arrives in _orders
-                if _id not in current_order_ids:
-                    return _id
-            else:
-                # new order is executed immediately
-                if len(self._executed_orders) > 0 \
-                 and self._executed_orders[-1][0] != last_executed_id:
-                    return self._executed_orders[-1][0]
-                time.sleep(self._sleep_time)
+        if return_id:
+            with self._updated:
+                return self._updated.wait_for(lambda: self._new_order_id(
+                    current_order_ids, last_executed_id))
+
+    def _new_order_id(self, order_ids, last_executed_id):
+        for _id in self._orders.copy().keys():
+            # new order arrives in _orders
+            if _id not in order_ids:
+                return _id
+        # new order is executed immediately
+        if self._last_executed_id != last_executed_id:
+            return self._last_executed_id
 
     def subscribe(self, symbol):
         """
         Subscribe to a symbol for price watching
         :param symbol: str: symbol to subscribe to (e.g. 'BTCUSD', 'ETHUSD'...)
         """
+        queue = self.wss.queue_processor.tickers[('ticker', symbol)]
+        notify_on_data(self._data_event, queue)
         self.symbols.append(symbol)
+        self._ticker_queues.append(('t' + symbol, queue))
         self.wss.subscribe_to_ticker(symbol)
 
     def wait_execution(self, _id, seconds=1e9):
@@ -358,29 +421,37 @@ class Trader(_Account):
         :return: dict: order in json format
         :raises: TimeoutError (if order is not executed in given time)
         """
-        start_time = time.time()
-        while time.time() - start_time < seconds:
-            try:
-                ids, trades = tuple(zip(*self._executed_orders))
-                return trades[ids.index(_id)]
-            except ValueError:
-                time.sleep(self._sleep_time)
+        with self._updated:
+            if self._updated.wait_for(lambda: _id in self._executed_orders,
+                                      min(seconds, TIMEOUT_MAX)):
+                return self._executed_orders[_id]
         raise TimeoutError('Waiting for execution of order '
                            '%d timed out after %d seconds' % (_id, seconds))
 
     def _receive(self):
+        account = self.wss.queue_processor.account
+        sources = tuple(account[source] for source in self._sources)
+        for queue in sources:
+            notify_on_data(self._data_event, queue)
+        update = self._update
         while not self._disconnect_event.is_set():
-            for source in self._sources:
-                with suppress(Empty):
-                    q = self.wss.queue_processor.account[source]
-                    cmd, data = q.get_nowait()[0]
-                    self._update(cmd, data)
-
-            for symbol in self.symbols:
-                with suppress(Empty):
-                    q = self.wss.queue_processor.tickers[('ticker', symbol)]
-                    data = q.get_nowait()[0]
-                    self._update('t' + symbol, data)
+            self._data_event.clear()
+            received = False
+            for queue in sources:
+                for (cmd, data), _ in queue.get_all():
+                    update(cmd, data)
+                    received = True
+
+            for cmd, queue in self._ticker_queues:
+                ticks = queue.get_all()
+                if ticks:
+                    # each tick replaces the price, only the newest matters
+                    update(cmd, ticks[-1][0])
+                    received = True
+
+            # Sleep until data arrives instead of spinning on empty queues
+            if not received:
+                self._data_event.wait(self._wait_timeout)
 
     def _subscribe(self):
         for symbol in self.symbols_gen:
@@ -1,6 +1,11 @@
+from collections import deque
 from contextlib import suppress
 from queue import Queue, Empty
+from threading import Event, Lock
+from types import SimpleNamespace
+import json
 import logging
+import random
 import time
 
 import requests
@@ -8,25 +13,157 @@ import btfxwss
 import btfxwss.queue_processor
 import btfxwss.connection
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 log = logging.getLogger(__name__)
+
+
+class _Queue:
+    """
+    Lock-free queue for one producer (the btfxwss queue processor) and one
+    consumer, built on deque's atomic append/popleft, that sets the events
+    registered with add_event when an item is put
+    """
+    def __init__(self):
+        self.queue = deque()
+        # Replaced on every change and never mutated, so that put can
+        # iterate it on the processor thread without taking the lock
+        self._events = frozenset()
+        self._events_lock = Lock()
+
+    def add_event(self, event):
+        with self._events_lock:
+            self._events = self._events | {event}
+
+    def remove_event(self, event):
+        with self._events_lock:
+            self._events = self._events - {event}
+
+    def empty(self):
+        return not self.queue
+
+    def qsize(self):
+        return len(self.queue)
+
+    def put(self, item, block=True, timeout=None):
+        self.queue.append(item)
+        for event in self._events:
+            event.set()
+
+    def put_nowait(self, item):
+        self.put(item)
+
+    def get(self, block=True, timeout=None):
+        if not block:
+            return self.get_nowait()
+        event = Event()
+        self.add_event(event)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            while True:
+                event.clear()
+                with suppress(Empty):
+                    return self.get_nowait()
+                if deadline is None:
+                    event.wait()
+                elif not event.wait(max(deadline - time.monotonic(), 0)):
+                    raise Empty
+        finally:
+            self.remove_event(event)
+
+    def get_nowait(self):
+        try:
+            return self.queue.popleft()
+        except IndexError:
+            raise Empty from None
+
+    def get_all(self):
+        """Remove and return all queued items without blocking"""
+        items = []
+        with suppress(IndexError):
+            while True:
+                items.append(self.queue.popleft())
+        return items
+
+
 # Multiprocessing queue is slow...
-btfxwss.connection.Queue = btfxwss.queue_processor.Queue = Queue
+btfxwss.connection.Queue = Queue
+btfxwss.queue_processor.Queue = _Queue
+# Decode websocket frames with orjson when it is installed
+if orjson is not None:
+    btfxwss.connection.json = SimpleNamespace(
+        loads=orjson.loads, dumps=json.dumps,
+        JSONDecodeError=json.JSONDecodeError
+    )
+
+
+def notify_on_data(event, queue):
+    """
+    Set an event whenever a websocket data queue receives data
+    :param event: threading.Event: event to set
+    :param queue: data queue of a BtfxWss queue processor
+    """
+    queue.add_event(event)
+
+
+# data type -> BtfxWss (subscribe, unsubscribe) method names
+_subscriptions = {
+    'tickers': ('subscribe_to_ticker', 'unsubscribe_from_ticker'),
+    'trades': ('subscribe_to_trades', 'unsubscribe_from_trades'),
+    'candles': ('subscribe_to_candles', 'unsubscribe_from_candles')
+}
+
+
+def _subscription(_type):
+    if isinstance(_type, tuple):
+        return _subscriptions['candles'], {'timeframe': _type[1]}
+    return _subscriptions[_type], {}
+
+
+_retry_statuses = {429, 500, 502, 503, 504}
+
+
+def _backoff(attempt, base=0.3, cap=8.):
+    """Exponential backoff delay with full jitter (in seconds)"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _get_json(url, attempts=5):
+    for attempt in range(1, attempts + 1):
+        retry_after = 0.
+        try:
+            response = requests.get(url, timeout=10)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == attempts:
+                raise
+            log.warning('GET %s failed (%d/%d): %r', url, attempt, attempts, e)
+        else:
+            if response.status_code not in _retry_statuses \
+                    or attempt == attempts:
+                response.raise_for_status()
+                return response.json()
+            log.warning('GET %s returned %d (%d/%d)', url,
+                        response.status_code, attempt, attempts)
+            with suppress(ValueError):
+                retry_after = float(response.headers.get('Retry-After', 0))
+        time.sleep(max(retry_after, _backoff(attempt)))
 
 
 def get_symbols():
-    return list(
-        map(lambda q: q.upper(),
-            filter(lambda i: 'usd' in i,
-                   requests.get('https://api.bitfinex.com/v1/symbols').json()))
-    )
+    symbols = _get_json('https://api.bitfinex.com/v1/symbols')
+    return [s.upper() for s in symbols if 'usd' in s]
 
 
-def get_symbols_as_updated(check_every=43200):
+def get_symbols_as_updated(check_every=43200, stop_event=None):
+    # stop_event ends the generator, even while waiting between checks
+    stop_event = stop_event or Event()
     symbols = set(get_symbols())
     for s in list(sorted(symbols)):
         yield s
-    while True:
-        time.sleep(check_every)
+    while not stop_event.wait(check_every):
         current_symbols = set(get_symbols())
         new_symbols = current_symbols.difference(symbols)
         symbols.update(new_symbols)
@@ -34,43 +171,45 @@ def get_symbols_as_updated(check_every=43200):
             yield s
 
 
-def _handle_ticker(data):
+def _handle_ticker(data, ts):
+    bid, bid_size, ask, ask_size, _, change, last_price, volume, high, low = \
+        data[0]
     return {
-        'bid': data[0][0], 'bid_size': data[0][1],
-        'ask': data[0][2], 'ask_size': data[0][3],
-        'mid': round((data[0][0] + data[0][2]) / 2, 4),
-        'weighted_mid': round((data[0][0] * data[0][1] +
-                               data[0][2] * data[0][3]) /
-                              (data[0][1] + data[0][3]), 4),
-        'last_price': data[0][6],
-        'spread': round(2 * (data[0][2] - data[0][0]) /
-                        (data[0][0] + data[0][2]), 8),
-        'change': data[0][5],
-        'volume': data[0][7],
-        'high': data[0][8],
-        'low': data[0][9],
-        'timestamp': round(time.time(), 0)
+        'bid': bid, 'bid_size': bid_size,
+        'ask': ask, 'ask_size': ask_size,
+        'mid': round((bid + ask) / 2, 4),
+        'weighted_mid': round((bid * bid_size + ask * ask_size) /
+                              (bid_size + ask_size), 4),
+        'last_price': last_price,
+        'spread': round(2 * (ask - bid) / (bid + ask), 8),
+        'change': change,
+        'volume': volume,
+        'high': high,
+        'low': low,
+        'timestamp': round(ts, 0)
     }
 
 
-def _handle_trade(data):
+def _handle_trade(data, ts):
     if data[0] == 'tu':
+        _id, timestamp, amount, price = data[1]
         return {
-            'id': data[1][0],
-            'timestamp': data[1][1] / 1000,
-            'price': data[1][3],
-            'amount': data[1][2]
+            'id': _id,
+            'timestamp': timestamp / 1000,
+            'price': price,
+            'amount': amount
         }
 
 
-def _handle_candle(data):
+def _handle_candle(data, ts):
+    timestamp, _open, high, low, close, volume = data[0]
     return {
-        'timestamp': data[0][0] / 1000,
-        'open': data[0][1],
-        'high': data[0][2],
-        'low': data[0][3],
-        'close': data[0][4],
-        'volume': data[0][5]
+        'timestamp': timestamp / 1000,
+        'open': _open,
+        'high': high,
+        'low': low,
+        'close': close,
+        'volume': volume
     }
 
 
@@ -87,22 +226,36 @@ class PublicData:
         '1h', '3h', '6h', '12h',
         '1D', '7D', '14D', '1M'
     ]
+    _wait_timeout = 1.
 
     def __init__(self, types=None, symbols=None):
         self.types = set(types or [])
         self.symbols = set(symbols or [])
         self._assert_types_are_correct(self.types)
         self.wss = btfxwss.BtfxWss(key='', secret='', log_level='CRITICAL')
+        # set by the queues this instance has read from
+        self._data_event = Event()
+        self._closed = Event()
+        # (type, symbol) -> (queue, handler), filled in on first read
+        self._readers = {}
 
     def __iter__(self):
-        while True:
+        while not self._closed.is_set():
+            self._data_event.clear()
+            received = False
             types, symbols = self.types.copy(), self.symbols.copy()
             for _type in types:
                 for symbol in symbols:
                     try:
-                        yield _type, symbol, self.get_nowait(_type, symbol)
+                        result = self._get_nowait(_type, symbol)
                     except Empty:
                         continue
+                    received = True
+                    if result is not None:
+                        yield _type, symbol, result
+            # Sleep until data arrives instead of spinning on empty queues
+            if not received:
+                self._data_event.wait(self._wait_timeout)
 
     def get(self, _type, symbol):
         """
@@ -111,16 +264,26 @@ class PublicData:
         :param symbol: str:
             symbol for which to get data (e.g. 'BTCUSD', 'ETHUSD'...)
         :return: dict: requested data in json format
-        :raises: AssertionError:
-            if either of the provided type and symbol are unrecognized
+        :raises:
+            AssertionError:
+                if either of the provided type and symbol are unrecognized
+            ConnectionError:
+                if the connection is closed while waiting for data
         """
         assert _type in self.types, "Unknown type '%s'" % _type
         assert symbol in self.symbols, "Unknown symbol '%s'" % symbol
         while True:
+            self._data_event.clear()
             try:
-                return self._get_nowait(_type, symbol)
+                result = self._get_nowait(_type, symbol)
             except Empty:
-                time.sleep(1e-6)
+                if self._closed.is_set():
+                    raise ConnectionError('Connection closed while waiting '
+                                          'for %s - %s' % (_type, symbol))
+                self._data_event.wait(self._wait_timeout)
+                continue
+            if result is not None:
+                return result
 
     def get_nowait(self, _type, symbol):
         """
@@ -138,7 +301,11 @@ class PublicData:
         """
         assert _type in self.types, "Unknown type '%s'" % _type
         assert symbol in self.symbols, "Unknown symbol '%s'" % symbol
-        return self._get_nowait(_type, symbol)
+        result = self._get_nowait(_type, symbol)
+        if result is None:
+            log.debug("%s - %s queue is empty", _type, symbol)
+            raise Empty
+        return result
 
     def subscribe(self, _type, symbol):
         """
@@ -151,18 +318,14 @@ class PublicData:
         self.types.add(_type)
         self.symbols.add(symbol)
 
-        if _type == 'tickers':
-            self.wss.subscribe_to_ticker(symbol)
-        elif _type == 'trades':
-            self.wss.subscribe_to_trades(symbol)
-        elif isinstance(_type, tuple):
-            self.wss.subscribe_to_candles(symbol, timeframe=_type[1])
+        (method, _), kwargs = _subscription(_type)
+        getattr(self.wss, method)(symbol, **kwargs)
 
     def connect(self):
         """Open a connection to a Bitfinex websocket"""
+        self._closed.clear()
         self.wss.start()
-        while not self.wss.conn.connected.is_set():
-            time.sleep(1e-4)
+        self.wss.conn.connected.wait()
 
         for _type in self.types:
             for symbol in self.symbols:
@@ -170,13 +333,14 @@ class PublicData:
 
     def close(self):
         """Close the connection to the Bitfinex websocket"""
-        for symbol in self.symbols:
-            with suppress(KeyError):
-                self.wss.unsubscribe_from_ticker(symbol)
-            with suppress(KeyError):
-                self.wss.unsubscribe_from_trades(symbol)
-            with suppress(KeyError):
-                self.wss.unsubscribe_from_candles(symbol)
+        # wake blocked readers so they see the connection is closed
+        self._closed.set()
+        self._data_event.set()
+        for _type in self.types:
+            (_, method), kwargs = _subscription(_type)
+            for symbol in self.symbols:
+                with suppress(KeyError):
+                    getattr(self.wss, method)(symbol, **kwargs)
         self.wss.stop()
 
     @staticmethod
@@ -216,19 +380,26 @@ class PublicData:
             _type = 'candles'
         return getattr(self.wss.queue_processor, _type)[pair]
 
-    def _get_nowait(self, _type, symbol):
+    def _get_reader(self, _type, symbol):
         if _type == 'tickers':
             handler = _handle_ticker
         elif _type == 'trades':
             handler = _handle_trade
         else:
             handler = _handle_candle
+        queue = self._get_queue(_type, symbol)
+        notify_on_data(self._data_event, queue)
+        reader = self._readers[_type, symbol] = queue, handler
+        return reader
 
-        log.debug("Getting %s - %s from queues", str(_type), symbol)
-        data = self._get_queue(_type, symbol).get_nowait()
-        result = handler(self._clean_data(_type, data))
-        if result is None:
-            log.debug("%s - %s queue is empty", _type, symbol)
-            raise Empty
+    def _get_nowait(self, _type, symbol):
+        try:
+            queue, handler = self._readers[_type, symbol]
+        except KeyError:
+            queue, handler = self._get_reader(_type, symbol)
 
-        return result
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Getting %s - %s from queues", _type, symbol)
+        data = queue.get_nowait()
+        # data is (payload, time received by the websocket)
+        return handler(self._clean_data(_type, data), data[1])
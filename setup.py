@@ -16,6 +16,10 @@ requirements = [
     'requests==2.19.1'
 ]
 
+extra_requirements = {
+    'orjson': ['orjson; python_version >= "3.6"']
+}
+
 setup_requirements = ['pytest-runner', ]
 
 test_requirements = ['pytest', ]
@@ -32,6 +36,7 @@ setup(
         'Programming Language :: Python :: 3.6',
     ],
     description="Simple to use wrappers for the Bitfinex web socket api",
+    extras_require=extra_requirements,
     install_requires=requirements,
     license="GNU General Public License v3",
     long_description=readme + '\n\n' + history,
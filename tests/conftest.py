@@ -1,25 +1,43 @@
 import os, sys
 sys.path.append(os.path.abspath('../btfx_trader'))
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
 from threading import Thread, Event
 from time import time, sleep
 from queue import Queue
 import pytest
-import random
 import btfxwss.queue_processor
 import requests
 from btfx_trader import PublicData, Trader
 
 
+# unique ids for orders created by tests and the test websocket
+_order_ids = count(1000000)
+
+
+def _order_row(_id, symbol, ts, remaining, amount, status, price,
+               executed_price=0.):
+    # Bitfinex websocket order row, only the fields the Trader reads are set
+    return [_id, '', '', 't' + symbol, '', ts, remaining, amount,
+            '', '', '', '', '', status, '', '', price, executed_price, '']
+
+
+class _TestConnection:
+    def __init__(self, connected):
+        self.connected = connected
+
+
 class TestWSS:
     def __init__(self, key=None, secret=None, log_level=None, tr=None):
         self.trader = tr
         self.key = key
         self.secret = secret
         self.log_level = log_level
+        self.cancelled_batches = []
         ev = Event()
         Thread(target=lambda: (sleep(1e-3), ev.set())).start()
-        self.conn = type('', (), {'connected': ev})
+        self.conn = _TestConnection(ev)
         self.queue_processor = btfxwss.queue_processor.QueueProcessor(
             data_q=Queue(), log_level='CRITICAL'
         )
@@ -52,24 +70,23 @@ class TestWSS:
         pass
 
     def new_order(self, **kwargs):
-        self.trader._update('on',
-              [kwargs.pop('id', None) or random.randint(1000000, 9999999),
-               '', '', kwargs.get('symbol'),
-               '', time() * 1000,
-               float(kwargs.get('amount')), float(kwargs.get('amount')), '', '',
-               '', '', '',
-               'ACTIVE', '', '', float(kwargs.get('price')), 0., '']
-        )
-
-    def cancel_order(self, **kwargs):
-        _id = kwargs.pop('id')
-        order = self.trader.orders[_id]
-        self.trader._update('oc', [
-            _id, '', '', 't' + order['symbol'], '',
-            order['timestamp'] * 1000, order['remaining'], order['amount'],
-            '', '', '', '', '',  'CANCELLED', '', '',
-            order['price'], order['executed_price'], ''
-        ])
+        amount = float(kwargs.get('amount'))
+        self.trader._update('on', _order_row(
+            kwargs.pop('id', None) or next(_order_ids),
+            kwargs.get('symbol')[1:], time() * 1000, amount, amount,
+            'ACTIVE', float(kwargs.get('price'))
+        ))
+
+    def cancel_order(self, multi=False, **kwargs):
+        ids = kwargs.pop('id')
+        self.cancelled_batches.append(ids)
+        for _id in (ids if multi else [ids]):
+            order = self.trader.orders[_id]
+            self.trader._update('oc', _order_row(
+                _id, order['symbol'], order['timestamp'] * 1000,
+                order['remaining'], order['amount'], 'CANCELLED',
+                order['price'], order['executed_price']
+            ))
 
 
 @pytest.fixture
@@ -93,48 +110,70 @@ def patched_get_symbols(monkeypatch):
     yield
 
 
+@pytest.fixture(scope='module')
+def executor():
+    ex = ThreadPoolExecutor(max_workers=2)
+    yield ex
+    ex.shutdown(wait=True)
+
+
 @pytest.fixture
-def data():
-    t = PublicData(
+def data(monkeypatch):
+    monkeypatch.setattr('btfxwss.BtfxWss', TestWSS)
+    return PublicData(
         types=['tickers', 'trades', ('candles', '1m')],
         symbols=['BTCUSD', 'LTCUSD', 'ETHUSD']
     )
-    t.wss = TestWSS('test_key', 'test_secret', log_level='CRITICAL')
-    return t
 
 
 @pytest.fixture
-def trader():
+def put_data():
+    def wrapper(d, name, pair, items):
+        queue = getattr(d.wss.queue_processor, name)[pair]
+        for item in items:
+            queue.put_nowait(item)
+    return wrapper
+
+
+@pytest.fixture
+def trader(monkeypatch):
+    monkeypatch.setattr('btfx_trader.private.BtfxWss', TestWSS)
     t = Trader('test_key', 'test_secret')
-    t.wss = TestWSS('test_key', 'test_secret', log_level='CRITICAL', tr=t)
+    t.wss.trader = t
     return t
 
 
+# Starting prices and wallet snapshot ($10000, no coins) for order tests
+_PRICES = {
+    'BTCUSD': 15000,
+    'ETHUSD': 700,
+    'LTCUSD': 300,
+    'DSHUSD': 1000,
+    'XRPUSD': 0.2
+}
+_WALLETS = [['EXCHANGE', 'usd', 10000., None, None]] + [
+    ['EXCHANGE', s[:-3].lower(), 0., None, None] for s in _PRICES]
+
+
 @pytest.fixture
 def setup_trader():
     def wrapped(t):
-        _wallets = [['EXCHANGE', s.lower().replace('usd', ''),
-                     0., None, None] for s in t.symbols]
-        t._update('ws', [['EXCHANGE', 'usd', 10000., None, None]] + _wallets)
-        t._prices = defaultdict(float)
-        t._prices.update({
-            'BTCUSD': 15000,
-            'ETHUSD': 700,
-            'LTCUSD': 300,
-            'DSHUSD': 1000,
-            'XRPUSD': 0.2
-        })
+        t._update('ws', _WALLETS)
+        t._prices = defaultdict(float, _PRICES)
     return wrapped
 
 
+@pytest.fixture
+def order_row():
+    return _order_row
+
+
 @pytest.fixture
 def new_order():
     def wrapper(tr, symbol, price, amount, ts=None, _id=None):
-        _id = _id or random.randint(1000000, 9999999)
-        tr._update('on',
-             [_id, '', '', 't'+symbol, '', (ts or time())*1000, amount, amount,
-              '', '', '', '', '',  'ACTIVE', '', '', price, 0., '']
-        )
+        _id = _id or next(_order_ids)
+        tr._update('on', _order_row(_id, symbol, (ts or time()) * 1000,
+                                    amount, amount, 'ACTIVE', price))
         return _id
     return wrapper
 
@@ -168,10 +207,9 @@ def update_order():
                 'EXCHANGE', s, tr._wallets[s] + tr._orders[_id]['executed'] + amount, None, None
             ])
 
-        tr._update(cmd, [_id, '', '', 't' + tr._orders[_id]['symbol'], '',
-                         (ts or time()) * 1000,
-                         tr._orders[_id]['remaining'] - amount,
-                         tr._orders[_id]['amount'],
-                         '', '', '', '', '',  status, '', '',
-                         price, exc_price, ''])
+        tr._update(cmd, _order_row(_id, tr._orders[_id]['symbol'],
+                                   (ts or time()) * 1000,
+                                   tr._orders[_id]['remaining'] - amount,
+                                   tr._orders[_id]['amount'],
+                                   status, price, exc_price))
     return wrapper
@@ -1,25 +1,54 @@
 from time import time, sleep
-from threading import Thread
 import pytest
+from btfx_trader.private import _jsonify_orders, _currency, _pair
 
 
 # ========================== #
 #       Account tests        #
 # ========================== #
 
-def test_connect_close(trader):
+def test_connect_close(patched_get_symbols, trader):
     trader.connect()
-    sleep(1e-4)
     assert trader.wss.conn.connected.is_set(), \
         'Trader connection not set after connect'
     trader.subscribe('BTCUSD')
     assert 'BTCUSD' in trader.symbols, 'Did not add symbol on subscribe'
     trader.close()
-    sleep(1e-4)
     assert trader._disconnect_event.is_set(), \
         'Trader did not set disconnect event on close'
 
 
+def test_jsonify_orders():
+    rows = _jsonify_orders([
+        [123, '', '', 'tBTCUSD', '', 1527273332589., 4., 10.,
+         '', '', '', '', '', 'PARTIALLY EXECUTED @ 45.0(6.0)', '', '',
+         50., 45., ''],
+        [456, '', '', 'tETHUSD', '', 1527273340000., 0., -2.,
+         '', '', '', '', '', 'ACTIVE', '', '', 700., 0., '']
+    ])
+    assert rows == [
+        (123, dict(symbol='BTCUSD', price=50., executed_price=45.,
+                   amount=10., executed=6., remaining=4.,
+                   status='PARTIALLY', timestamp=1527273332.589)),
+        (456, dict(symbol='ETHUSD', price=700., executed_price=0.,
+                   amount=-2., executed=-2., remaining=0.,
+                   status='ACTIVE', timestamp=1527273340.))
+    ], 'Incorrect order json'
+
+
+@pytest.mark.parametrize('symbol, currency, pair', [
+    ('BTCUSD', 'btc', 'BTCUSD'),
+    ('btc', 'btc', 'BTCUSD'),
+    ('DSHUSD', 'dsh', 'DSHUSD'),
+    ('USDTUSD', 'usdt', 'USDTUSD'),
+    ('usdt', 'usdt', 'USDTUSD'),
+    ('SUSD', 's', 'SUSD'),
+])
+def test_symbol_currency(symbol, currency, pair):
+    assert _currency(symbol) == currency, 'Incorrect wallet currency'
+    assert _pair(symbol) == pair, 'Incorrect ticker symbol'
+
+
 def test_wallets_update(trader):
     # wallet init
     trader._update('ws', [
@@ -27,78 +56,72 @@ def test_wallets_update(trader):
         ['EXCHANGE', 'btc', 10., None, None],
         ['EXCHANGE', 'eth', 5., None, None]
     ])
-    sleep(0.002)  # wait for thread to update
     assert trader.wallets['usd'] == 100., 'Did not update usd in wallet'
     assert trader.wallets['btc'] == 10., 'Did not update btc in wallet'
     assert trader.wallets['eth'] == 5., 'Did not update eth in wallet'
     # wallet updates
     trader._update('wu', ['EXCHANGE', 'usd', 50., None, None])
     trader._update('wu', ['EXCHANGE', 'btc', 20., None, None])
-    sleep(0.004)  # wait for thread to update
     assert trader.wallets['usd'] == 50., 'Did not update usd in wallet'
     assert trader.wallets['btc'] == 20., 'Did not update btc in wallet'
     assert trader.wallets['eth'] == 5., 'Did not update eth in wallet'
 
 
-def test_orders_init_execute(trader):
+def test_wallets_parse_numeric_strings(trader):
+    trader._update('ws', [['EXCHANGE', 'usd', '100.5', None, None]])
+    trader._update('wu', ['EXCHANGE', 'btc', '1e-3', None, None])
+    assert trader.wallets['usd'] == 100.5, 'Did not parse wallet string'
+    assert trader.wallets['btc'] == 0.001, 'Did not parse wallet string'
+    # balances are parsed as numbers only, never evaluated
+    with pytest.raises(ValueError):
+        trader._update('wu', ['EXCHANGE', 'eth', '__import__("os")',
+                              None, None])
+
+
+# Active BTCUSD order that the order tests derive their expected json from
+BASE_ORDER = dict(
+    symbol='BTCUSD', price=50., executed_price=0., amount=10.,
+    executed=0., remaining=10., status='ACTIVE', timestamp=0.,
+)
+
+
+def test_orders_init_execute(trader, order_row):
     # orders init
     ts = time() * 1000
     expected_json_init = dict(
-            symbol='BTCUSD', price=50., executed_price=45., amount=10.,
-            executed=5., remaining=5., status='PARTIALLY', timestamp=ts / 1000,
-        )
-    trader._update('os', [
-        [123, '', '', 'tBTCUSD', '', ts, 5., 10., '', '', '', '', '',  'PARTIALLY EXECUTED', '', '', 50., 45., '']
-    ])
-    sleep(0.002)  # wait for thread to update
-    assert trader.orders[123] == expected_json_init, 'Incorrect order on init'
-    assert trader.orders[123] == list(trader.orders.values())[-1], 'Incorrect latest order'
-    assert len(trader.orders) == 1, 'Incorrect length of orders'
-    # execute order
-    ts = time() * 1000
+        BASE_ORDER, executed_price=45., executed=5., remaining=5.,
+        status='PARTIALLY', timestamp=ts / 1000)
+    trader._update('os', [order_row(123, 'BTCUSD', ts, 5., 10.,
+                                    'PARTIALLY EXECUTED', 50., 45.)])
+    assert trader.orders == {123: expected_json_init}, \
+        'Incorrect orders on init'
+    # execute order a second later
+    ts += 1000
     expected_json_execute = dict(
-            symbol='BTCUSD', price=50., executed_price=43., amount=10.,
-            executed=10., remaining=0., status='EXECUTED', timestamp=ts / 1000,
-        )
-    trader._update(
-        'oc',
-        [123, '', '', 'tBTCUSD', '', ts, 0., 10., '', '', '', '', '',  'EXECUTED @', '', '', 50., 43., '']
-    )
-    sleep(0.002)  # wait for thread to update
-    assert 123 not in trader.orders, 'Did not remove executed order'
-    assert len(trader.orders) == 0, 'Incorrect length of orders'
-    assert list(trader.executed_orders.items())[-1] == (123, expected_json_execute), \
+        BASE_ORDER, executed_price=43., executed=10., remaining=0.,
+        status='EXECUTED', timestamp=ts / 1000)
+    trader._update('oc', order_row(123, 'BTCUSD', ts, 0., 10.,
+                                   'EXECUTED @', 50., 43.))
+    assert trader.orders == {}, 'Did not remove executed order'
+    assert next(reversed(trader.executed_orders.items())) == (123, expected_json_execute), \
         'Incorrect order json added to executed orders'
 
 
 def test_orders_update(trader, new_order, update_order):
     # new order
     ts = round(time(), 2)
-    expected_json_new = dict(
-            symbol='BTCUSD', price=50., executed_price=0., amount=10.,
-            executed=0., remaining=10., status='ACTIVE', timestamp=ts,
-        )
+    expected_json_new = dict(BASE_ORDER, timestamp=ts)
     _id = new_order(trader, 'BTCUSD', 50., 10., ts=ts)
-    sleep(0.002)  # wait for thread to update
-    assert trader.orders[_id] == expected_json_new, 'Incorrect new order'
-    assert trader.orders[_id] == list(trader.orders.values())[-1], 'Incorrect latest order'
-    assert len(trader.orders) == 1, 'Incorrect length of orders'
-    # update order
-    ts = round(time(), 2)
-    expected_json_update = dict(
-            symbol='BTCUSD', price=25., executed_price=0., amount=10.,
-            executed=0., remaining=10., status='ACTIVE', timestamp=ts,
-        )
+    assert trader.orders == {_id: expected_json_new}, 'Incorrect new order'
+    # update order a second later
+    ts += 1
+    expected_json_update = dict(BASE_ORDER, price=25., timestamp=ts)
     update_order(trader, _id, 25, 0., ts=ts)
-    sleep(0.002)  # wait for thread to update
-    assert trader.orders[_id] == expected_json_update, 'Incorrect update order'
-    assert trader.orders[_id] == list(trader.orders.values())[-1], 'Incorrect latest order'
-    assert len(trader.orders) == 1, 'Incorrect length of orders'
+    assert trader.orders == {_id: expected_json_update}, \
+        'Incorrect update order'
     # cancel order
     update_order(trader, _id, 25, 0, cancel=True)
-    sleep(0.002)  # wait for thread to update
-    assert _id not in trader.orders, 'Did not remove cancelled order'
-    assert len(trader.orders) == 0, 'Incorrect length of orders'
+    assert trader.orders == {}, 'Did not remove cancelled order'
 
 
 def test_available_balances(trader, setup_trader, new_order, update_order):
@@ -134,6 +157,22 @@ def test_available_balances(trader, setup_trader, new_order, update_order):
         'Incorrect wallet value after execute sell ETHUSD'
 
 
+def test_available_balances_partial_update(trader, setup_trader, new_order,
+                                           update_order):
+    setup_trader(trader)
+    _id = new_order(trader, 'BTCUSD', 15000, 0.02)
+    assert trader.available_balances['usd'] == 9700., \
+        'Incorrect wallet value after buy BTCUSD'
+    update_order(trader, _id, 15000, 0.01)
+    assert trader.available_balances['usd'] == 9700., \
+        'Incorrect wallet value after partial execution of BTCUSD'
+    assert trader.available_balances['btc'] == 0.01, \
+        'Incorrect wallet value after partial execution of BTCUSD'
+    update_order(trader, _id, 15000, 0., cancel=True)
+    assert trader.available_balances['usd'] == 9850., \
+        'Incorrect wallet value after cancel of BTCUSD'
+
+
 def test_position(trader, setup_trader):
     setup_trader(trader)
     assert trader.positions['BTCUSD'] == 0., 'Incorrect position with no coin'
@@ -159,16 +198,16 @@ def test_value(trader, setup_trader, new_order, update_order):
     assert trader.value == 10150., 'Incorrect value after price increase'
 
 
-def test_value_after_price_update(patched_get_symbols, trader, setup_trader):
+def test_value_after_price_update(patched_get_symbols, trader, setup_trader,
+                                  order_row):
     setup_trader(trader)
     trader._wallets['btc'] = 0.1
     trader.connect()
     _id = trader.order('BTCUSD', 15000, dollar_amount=150)
     value = trader.value
     trader.wss.queue_processor.account['Order Cancel'].put(
-        [['oc', [_id, '', '', 'tBTCUSD', '', time() * 1000, 0, 0.01,
-                 '', '', '', '', '', 'CANCELLED', '', '', 15000, 0, '']
-          ], 0]
+        [['oc', order_row(_id, 'BTCUSD', time() * 1000, 0, 0.01,
+                          'CANCELLED', 15000)], 0]
     )
     trader.wss.queue_processor.tickers[('ticker', 'BTCUSD')].put(
         [[[
@@ -176,12 +215,42 @@ def test_value_after_price_update(patched_get_symbols, trader, setup_trader):
             7429.8, 26839.8, 7654.1, 7318.2
         ]], 1527273347.1]
     )
-    now, diff = time(), 0
-    while trader.value == value and diff < 5e-3:
-        sleep(1e-5)
-        diff = time() - now
+    with trader._updated:
+        changed = trader._updated.wait_for(
+            lambda: trader.value != value, timeout=1)
+    trader.close()
+    assert changed, 'Did not update value in allotted time'
+
+
+def test_receive_wakes_on_put(patched_get_symbols, trader):
+    trader._wait_timeout = 10
+    trader.connect()
+    sleep(0.05)  # let the receiver go idle
+    trader.wss.queue_processor.account['Wallets'].put(
+        [['wu', ['exchange', 'usd', 50., None, None]], 0])
+    deadline = time() + 0.5
+    while trader.wallets['usd'] != 50. and time() < deadline:
+        sleep(1e-3)
     trader.close()
-    assert trader.value != value, 'Did not update value in allotted time'
+    assert trader.wallets['usd'] == 50., 'Receiver did not wake on put'
+
+
+def test_receive_applies_latest_tick(patched_get_symbols, trader):
+    handled = []
+    handle_ticker = trader._handlers['t']
+    trader._handlers['t'] = lambda cmd, data: (
+        handled.append(data), handle_ticker(cmd, data))
+    trader.subscribe('BTCUSD')
+    queue = trader.wss.queue_processor.tickers[('ticker', 'BTCUSD')]
+    for bid in (7000., 7100., 7200.):
+        queue.put([[[bid, 1., bid, 1., 0., 0., 0., 0., 0., 0.]], 0])
+    trader.connect()
+    deadline = time() + 0.5
+    while not handled and time() < deadline:
+        sleep(1e-3)
+    trader.close()
+    assert len(handled) == 1, 'Did not coalesce queued ticks'
+    assert trader._prices['BTCUSD'] == 7200., 'Did not apply the latest tick'
 
 
 # ========================== #
@@ -197,59 +266,124 @@ def test_cancel_single(trader, setup_trader, new_order):
     assert len(trader.orders) == 1, 'Did not cancel order'
 
 
-def test_cancel_all(trader, setup_trader, new_order):
+def test_cancel_all(trader, setup_trader, order_row):
     setup_trader(trader)
     now = time()
-    for i in range(10):
-        new_order(trader, 'BTCUSD', 15000, 0.01, ts=now - i * 10)
+    trader._update('os', [
+        order_row(i + 1, 'BTCUSD', (now - i * 10) * 1000, 0.01, 0.01,
+                  'ACTIVE', 15000) for i in range(10)
+    ])
     assert len(trader.orders) == 10, 'Did not add all orders'
     trader.cancel_all(older_than=50)
     assert len(trader.orders) == 5, 'Did not cancel all orders'
+    assert len(trader.wss.cancelled_batches) == 1, \
+        'Did not cancel orders in a single request'
 
 
-def test_wait_execution(trader, setup_trader, new_order, update_order):
+def test_wait_execution(trader, setup_trader, new_order, update_order,
+                        executor):
     setup_trader(trader)
     _id = new_order(trader, 'BTCUSD', 15000, 0.01)
     with pytest.raises(TimeoutError):
        trader.wait_execution(_id, seconds=0.001)
-    del trader._orders[_id]
+    update_order(trader, _id, 15000, 0, cancel=True)
+    assert _id not in trader.orders, 'Did not cancel order'
     _id = new_order(trader, 'BTCUSD', 15000, 0.01)
-    result = []
-
-    def wait(_idd, _wait):
-        result.append(trader.wait_execution(_idd, seconds=_wait))
-    t = Thread(target=wait, args=(_id, 0.1))
-    t.start()
+    future = executor.submit(trader.wait_execution, _id, seconds=0.1)
     update_order(trader, _id, 15150, 0.01, execute=True)
-    t.join()
+    result = future.result()
     assert len(trader.executed_orders) == 1, 'Did not execute order'
-    assert list(trader.executed_orders.items())[-1] == (_id, result[0]), 'Incorrect items in orders'
+    assert next(reversed(trader.executed_orders.items())) == (_id, result), 'Incorrect items in orders'
+
+
+def test_wait_execution_concurrent_waiters(trader, setup_trader, new_order,
+                                           update_order, executor):
+    setup_trader(trader)
+    _id = new_order(trader, 'BTCUSD', 15000, 0.01)
+    waiter = executor.submit(trader.wait_execution, _id, seconds=5)
+    with pytest.raises(TimeoutError):
+        trader.wait_execution(_id, seconds=0.001)
+    update_order(trader, _id, 15150, 0.01, execute=True)
+    assert waiter.result(1)['price'] == 15150, \
+        'Timed out waiter stopped other waiters from being woken'
+
+
+def test_wait_execution_history(trader, setup_trader, new_order,
+                                update_order):
+    setup_trader(trader)
+    ids = []
+    for _ in range(trader._max_order_history + 1):
+        _id = new_order(trader, 'BTCUSD', 15000, 0.01)
+        update_order(trader, _id, 15000, 0.01, execute=True)
+        ids.append(_id)
+    assert trader.wait_execution(ids[-1], seconds=0)['price'] == 15000, \
+        'Did not return already executed order'
+    assert len(trader.executed_orders) == trader._max_order_history, \
+        'Executed order history grew past its maximum length'
+    assert next(iter(trader.executed_orders)) == ids[1], \
+        'Did not evict the oldest executed order'
+    trader.executed_orders[ids[0]] = {}
+    assert ids[0] not in trader.executed_orders, \
+        'Executed order history was mutated through a returned copy'
+    with pytest.raises(TimeoutError):
+        trader.wait_execution(ids[0], seconds=0.001)
 
 
 def test_order_multiple_args_fails(trader, setup_trader):
     setup_trader(trader)
-    with pytest.raises(AssertionError):
+    with pytest.raises(ValueError):
         trader.order("BTCUSD", 15000., dollar_amount=1000, ratio=0.5)
 
 
-def test_order_dollar_amount(trader, setup_trader, update_order):
+@pytest.mark.parametrize('price, kwargs, message', [
+    (15000., {}, 'Must provide either'),
+    (15000., {'dollar_amount': 100, 'trade_type': 'stop'}, 'Unknown trade'),
+    (0.001, {'dollar_amount': 100}, 'Price cannot be less'),
+    (15000., {'dollar_amount': 10}, 'below minimum'),
+    (15000., {'dollar_amount': 20000}, 'above maximum'),
+])
+def test_order_invalid_args_fail(trader, setup_trader, price, kwargs, message):
     setup_trader(trader)
-    symbol, price = "BTCUSD", 15000.
+    with pytest.raises(ValueError, match=message):
+        trader.order("BTCUSD", price, **kwargs)
+    assert len(trader.orders) == 0, 'Submitted an invalid order'
+
+
+ORDER_DATA = [
+    # symbol, price, buy kwargs, usd after buy, sell kwargs, usd after sell
+    ('BTCUSD', 15000., {'dollar_amount': 1000}, 9000,
+     {'dollar_amount': -1000}, 10000),
+    ('BTCUSD', 15000., {'value_ratio': 0.5}, 5000,
+     {'value_ratio': -0.5}, 10000),
+    ('BTCUSD', 'market', {'dollar_amount': 1000}, 9000,
+     {'dollar_amount': -1000}, 10000),
+    ('DSHUSD', 1000., {'dollar_amount': 1100, 'pad_price': 0.1}, 8900,
+     {'dollar_amount': -900, 'pad_price': 0.1}, 9800),
+]
+
+
+@pytest.mark.parametrize('symbol,price,buy,buy_usd,sell,sell_usd', ORDER_DATA,
+                         ids=['dollar_amount', 'value_ratio', 'market',
+                              'pad_price'])
+def test_order(trader, setup_trader, update_order,
+               symbol, price, buy, buy_usd, sell, sell_usd):
+    setup_trader(trader)
+    currency = symbol[:-3].lower()
     # buy
-    _id = trader.order(symbol, price, dollar_amount=1000)
-    assert round(trader.available_balances['usd'], 2) == 9000, \
+    _id = trader.order(symbol, price, **buy)
+    assert round(trader.available_balances['usd'], 2) == buy_usd, \
         'Did not buy correct amount'
     amount = trader.orders[_id]['amount']
-    update_order(trader, _id, price, amount, execute=True)
-    assert round(trader.available_balances['btc'], 8) == amount, \
+    update_order(trader, _id, trader.orders[_id]['price'], amount, execute=True)
+    assert round(trader.available_balances[currency], 8) == amount, \
         'Did not buy correct amount'
     # sell
-    _id = trader.order(symbol, price, dollar_amount=-1000)
-    assert round(trader.available_balances['btc'], 8) == 0, \
+    _id = trader.order(symbol, price, **sell)
+    assert round(trader.available_balances[currency], 8) == 0, \
         'Did not sell correct amount'
     amount = trader.orders[_id]['amount']
-    update_order(trader, _id, price, amount, execute=True)
-    assert round(trader.available_balances['usd'], 2) == 10000, \
+    update_order(trader, _id, trader.orders[_id]['price'], amount, execute=True)
+    assert round(trader.available_balances['usd'], 2) == sell_usd, \
         'Did not sell correct amount'
 
 
@@ -281,72 +415,10 @@ def test_order_ratio(trader, setup_trader, update_order):
         'Did not sell correct amount'
 
 
-def test_order_value_ratio(trader, setup_trader, update_order):
-    setup_trader(trader)
-    symbol, price = "BTCUSD", 15000.
-    # buy
-    _id = trader.order(symbol, price, value_ratio=0.5)
-    assert round(trader.available_balances['usd'], 2) == 5000, \
-        'Did not buy correct amount'
-    amount = trader.orders[_id]['amount']
-    update_order(trader, _id, price, amount, execute=True)
-    assert round(trader.available_balances['btc'], 8) == amount, \
-        'Did not buy correct amount'
-    # sell
-    _id = trader.order(symbol, price, value_ratio=-0.5)
-    assert round(trader.available_balances['btc'], 8) == 0, \
-        'Did not sell correct amount'
-    amount = trader.orders[_id]['amount']
-    update_order(trader, _id, price, amount, execute=True)
-    assert round(trader.available_balances['usd'], 2) == 10000, \
-        'Did not sell correct amount'
-
-
-def test_order_market(trader, setup_trader, update_order):
-    setup_trader(trader)
-    # buy
-    _id = trader.order("BTCUSD", 'market', dollar_amount=1000)
-    assert round(trader.available_balances['usd'], 2) == 9000, \
-        'Did not buy correct amount'
-    amount = trader.orders[_id]['amount']
-    update_order(trader, _id, 15000., amount, execute=True)
-    assert round(trader.available_balances['btc'], 8) == amount, \
-        'Did not buy correct amount'
-    # sell
-    _id = trader.order("BTCUSD", 'market', dollar_amount=-1000)
-    assert round(trader.available_balances['btc'], 8) == 0, \
-        'Did not sell correct amount'
-    amount = trader.orders[_id]['amount']
-    update_order(trader, _id, 15000., amount, execute=True)
-    assert round(trader.available_balances['usd'], 2) == 10000, \
-        'Did not sell correct amount'
-
-
-def test_order_pad_price(trader, setup_trader, update_order):
-    setup_trader(trader)
-    symbol, price = "DSHUSD", 1000.
-    # buy
-    _id = trader.order(symbol, price, dollar_amount=1100, pad_price=0.1)
-    assert round(trader.available_balances['usd'], 2) == 8900, \
-        'Did not buy correct amount'
-    amount = trader.orders[_id]['amount']
-    update_order(trader, _id, trader.orders[_id]['price'], amount, execute=True)
-    assert round(trader.available_balances['dsh'], 8) == amount, \
-        'Did not buy correct amount'
-    # sell
-    _id = trader.order(symbol, price, dollar_amount=-900, pad_price=0.1)
-    assert round(trader.available_balances['dsh'], 8) == 0, \
-        'Did not sell correct amount'
-    amount = trader.orders[_id]['amount']
-    update_order(trader, _id, trader.orders[_id]['price'], amount, execute=True)
-    assert round(trader.available_balances['usd'], 2) == 9800, \
-        'Did not sell correct amount'
-
-
-def test_order_id_with_previous_executed_orders(trader, setup_trader, update_order):
+def test_order_id_with_previous_executed_orders(trader, setup_trader,
+                                                update_order, executor):
     setup_trader(trader)
     old_order = trader.wss.new_order
-    trader._sleep_time = 1e-6
 
     def execute_on_order(**kwargs):
         def wrapped():
@@ -355,7 +427,7 @@ def test_order_id_with_previous_executed_orders(trader, setup_trader, update_ord
                       symbol='tBTCUSD', price=kwargs.get('price'),
                       amount=kwargs.get('amount'), id=123)
             update_order(trader, 123, 15000, 0.01, execute=True)
-        Thread(target=wrapped).start()
+        executor.submit(wrapped)
 
     trader.wss.new_order = execute_on_order
     trader.order('BTCUSD', 15000, dollar_amount=300)
@@ -1,8 +1,12 @@
+from contextlib import suppress
 from queue import Empty
-from threading import Timer
-from time import sleep
+from threading import Event, Thread, Timer
+from time import sleep, time
+import json
+import btfxwss.connection
 import pytest
-from btfx_trader import get_symbols_as_updated
+import requests
+from btfx_trader import get_symbols, get_symbols_as_updated
 
 NOWAIT_DATA = [
     (
@@ -33,18 +37,26 @@ def test_get_symbols_as_updated(patched_get_symbols):
         assert symbol == expected, 'Did not get correct symbol from gen'
 
 
+def test_get_symbols_as_updated_stops(patched_get_symbols):
+    stop = Event()
+    gen = iter(get_symbols_as_updated(check_every=10, stop_event=stop))
+    assert len([next(gen) for _ in range(3)]) == 3, 'Did not get symbols'
+    Timer(1e-3, stop.set).start()
+    start = time()
+    assert list(gen) == [], 'Got symbols after stop'
+    assert time() - start < 1, 'Did not stop while waiting for next check'
+
+
 def test_connect_close(data):
     data.connect()
-    sleep(1e-4)
     assert data.wss.conn.connected.is_set(), \
         'Data connection not set after connect'
     data.close()
 
 
 @pytest.mark.parametrize('name,pair,data_to_put,keys,values', NOWAIT_DATA)
-def test_get_nowait(data, name, pair, data_to_put, keys, values):
-    for d in data_to_put:
-        getattr(data.wss.queue_processor, name)[pair].put_nowait(d)
+def test_get_nowait(data, put_data, name, pair, data_to_put, keys, values):
+    put_data(data, name, pair, data_to_put)
     if name == 'candles':
         name = ('candles', '1m')
     try:
@@ -56,23 +68,20 @@ def test_get_nowait(data, name, pair, data_to_put, keys, values):
 
 
 @pytest.mark.parametrize('name,pair,data_to_put,keys,values', NOWAIT_DATA)
-def test_get(data, name, pair, data_to_put, keys, values):
-    def put(n, p, dd):
-        for _d in dd:
-            getattr(data.wss.queue_processor, n)[p].put(_d)
-
-    Timer(1e-4, put, args=[name, pair, data_to_put]).start()
-    if name == 'candles':
-        name = ('candles', '1m')
-    d = data.get(name, 'BTCUSD')
+def test_get(data, put_data, executor, name, pair, data_to_put, keys, values):
+    # put after get has started blocking
+    put = executor.submit(
+        lambda: (sleep(1e-4), put_data(data, name, pair, data_to_put)))
+    _type = ('candles', '1m') if name == 'candles' else name
+    d = data.get(_type, 'BTCUSD')
+    put.result()
     for k, v in zip(keys, values):
-        assert d[k] == v, 'Did not get correct data for %s' % str(name)
+        assert d[k] == v, 'Did not get correct data for %s' % str(_type)
 
 
-def test_iter(data):
+def test_iter(data, put_data):
     for name, pair, d, _, _ in NOWAIT_DATA:
-        for _d in d:
-            getattr(data.wss.queue_processor, name)[pair].put_nowait(_d)
+        put_data(data, name, pair, d)
     count = 0
     types = {'tickers', 'trades', ('candles', '1m')}
     for _type, symbol, d in data:
@@ -81,3 +90,204 @@ def test_iter(data):
         count += 1
         if count >= 2:
             break
+
+
+@pytest.mark.parametrize('name,pair,data_to_put,expected', [
+    (
+        'tickers', ('ticker', 'BTCUSD'),
+        # distinct bid/ask sizes so that swapped fields change weighted_mid
+        [([[7500.0, 1., 7501.0, 3., -1.0, -0.01,
+            7429.8, 26839.8, 7654.1, 7318.2]], 1527273347.1)],
+        {
+            'bid': 7500.0, 'bid_size': 1., 'ask': 7501.0, 'ask_size': 3.,
+            'mid': 7500.5, 'weighted_mid': 7500.75,
+            'last_price': 7429.8, 'spread': round(2 / 15001, 8),
+            'change': -0.01, 'volume': 26839.8,
+            'high': 7654.1, 'low': 7318.2, 'timestamp': 1527273347.0
+        }
+    ),
+    (
+        'trades', ('trades', 'BTCUSD'), NOWAIT_DATA[1][2][1:],
+        {
+            'id': 250014166, 'timestamp': 1527273332.589,
+            'price': 7500.0, 'amount': -0.5
+        }
+    ),
+    (
+        'candles', ('candles', 'BTCUSD', '1m'), NOWAIT_DATA[2][2],
+        {
+            'timestamp': 1527273240.0, 'open': 7500.0, 'high': 7500.8,
+            'low': 7500.0, 'close': 7500.5, 'volume': 0.5
+        }
+    )
+])
+def test_get_nowait_all_fields(data, put_data, name, pair, data_to_put,
+                               expected):
+    put_data(data, name, pair, data_to_put)
+    if name == 'candles':
+        name = ('candles', '1m')
+    d = data.get_nowait(name, 'BTCUSD')
+    assert d == expected, 'Incorrect fields for %s' % str(name)
+
+
+def test_get_skips_dropped_frame(data, put_data):
+    # 'te' frames are dropped, the 'tu' frame behind it must still be returned
+    data._wait_timeout = 10
+    put_data(data, 'trades', ('trades', 'BTCUSD'), NOWAIT_DATA[1][2])
+    result = []
+    t = Thread(target=lambda: result.append(data.get('trades', 'BTCUSD')))
+    t.daemon = True
+    t.start()
+    t.join(0.5)
+    assert result and result[0]['price'] == 7500.0, \
+        'get blocked on a dropped frame'
+
+
+def test_iter_wakes_on_put(data):
+    data._wait_timeout = 10
+    result = []
+    t = Thread(target=lambda: result.append(next(iter(data))))
+    t.daemon = True
+    t.start()
+    sleep(0.05)
+    assert not result, 'Iterator returned data before any was put'
+    data.wss.queue_processor.tickers[('ticker', 'BTCUSD')].put(
+        NOWAIT_DATA[0][2][0])
+    t.join(0.5)
+    assert result and result[0][:2] == ('tickers', 'BTCUSD'), \
+        'Iterator did not wake on put'
+
+
+def test_only_read_queues_wake_reader(data):
+    with pytest.raises(Empty):
+        data.get_nowait('tickers', 'BTCUSD')
+    data._data_event.clear()
+    data.wss.queue_processor.trades[('trades', 'BTCUSD')].put(
+        NOWAIT_DATA[1][2][0])
+    assert not data._data_event.is_set(), 'Woken by a queue it never read'
+    data.wss.queue_processor.tickers[('ticker', 'BTCUSD')].put(
+        NOWAIT_DATA[0][2][0])
+    assert data._data_event.is_set(), 'Not woken by a queue it reads'
+
+
+def test_close_stops_readers(data):
+    data._wait_timeout = 10
+    iterated, errors = [], []
+
+    def get():
+        try:
+            data.get('tickers', 'BTCUSD')
+        except ConnectionError as e:
+            errors.append(e)
+
+    threads = [Thread(target=lambda: iterated.extend(data)),
+               Thread(target=get)]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    sleep(0.05)
+    data.close()
+    for t in threads:
+        t.join(0.5)
+        assert not t.is_alive(), 'Reader did not stop on close'
+    assert not iterated, 'Iterator returned data after close'
+    assert len(errors) == 1, 'Blocked get did not raise on close'
+
+
+def test_close_unsubscribes_subscribed_types(data):
+    calls = []
+    data.wss.unsubscribe_from_ticker = lambda s: calls.append(('t', s))
+    data.wss.unsubscribe_from_trades = lambda s: calls.append(('tr', s))
+    data.wss.unsubscribe_from_candles = \
+        lambda s, timeframe=None: calls.append(('c', s, timeframe))
+    data.close()
+    assert sorted(calls) == sorted(
+        [('t', s) for s in data.symbols] +
+        [('tr', s) for s in data.symbols] +
+        [('c', s, '1m') for s in data.symbols]
+    ), 'Did not unsubscribe from every subscribed stream'
+
+
+def test_queue_get_all(data):
+    q = data.wss.queue_processor.trades[('trades', 'BTCUSD')]
+    for d in NOWAIT_DATA[1][2]:
+        q.put(d)
+    assert q.get_all() == NOWAIT_DATA[1][2], 'Did not drain queue in order'
+    assert q.empty() and q.get_all() == [], 'Did not empty queue'
+
+
+def test_queue_get_blocks_until_put(data):
+    q = data.wss.queue_processor.candles[('candles', 'BTCUSD', '1m')]
+    with pytest.raises(Empty):
+        q.get(timeout=1e-3)
+    Timer(1e-3, q.put, args=['candle']).start()
+    assert q.get(timeout=1) == 'candle', 'Did not get item put while blocked'
+
+
+def test_queue_concurrent_put_get(data):
+    q = data.wss.queue_processor.trades[('trades', 'BTCUSD')]
+    stop, errors = Event(), []
+
+    def run(target):
+        try:
+            while not stop.is_set():
+                target()
+        except Exception as e:
+            errors.append(e)
+
+    def get():
+        with suppress(Empty):
+            q.get(timeout=0)
+
+    def add_remove():
+        event = Event()
+        q.add_event(event)
+        q.remove_event(event)
+
+    threads = [Thread(target=run, args=[f])
+               for f in [lambda: q.put('x'), get, get, add_remove]]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    sleep(0.2)
+    stop.set()
+    for t in threads:
+        t.join(1)
+    assert not errors, 'Concurrent put and get raised %r' % errors
+    assert not q._events, 'Blocking get left its event registered'
+
+
+def test_websocket_json_decoding():
+    frame = '[0, "tu", [250014166, 1527273332589, -0.5, 7500.1]]'
+    decode = btfxwss.connection.json.loads
+    assert decode(frame) == json.loads(frame), 'Incorrect frame decoding'
+    with pytest.raises(btfxwss.connection.json.JSONDecodeError):
+        decode('{"event": ')
+
+
+def test_websocket_json_decoding_uses_orjson():
+    orjson = pytest.importorskip('orjson')
+    assert btfxwss.connection.json.loads is orjson.loads, \
+        'Did not decode websocket frames with orjson'
+
+
+def test_get_symbols_retries(monkeypatch):
+    responses = [(503, {'Retry-After': '2'}), (429, {}),
+                 (200, {}), (400, {})]
+    sleeps = []
+
+    def fake_get(*args, **kwargs):
+        r = requests.Response()
+        r.status_code, headers = responses.pop(0)
+        r.headers.update(headers)
+        r._content = b'["btcusd","ethltc"]'
+        return r
+
+    monkeypatch.setattr('requests.get', fake_get)
+    monkeypatch.setattr('time.sleep', sleeps.append)
+    assert get_symbols() == ['BTCUSD'], 'Did not retry retriable statuses'
+    assert len(sleeps) == 2 and sleeps[0] >= 2, \
+        'Did not back off or honor Retry-After'
+    with pytest.raises(requests.HTTPError):
+        get_symbols()
+    assert len(sleeps) == 2, 'Retried a non-retriable status'